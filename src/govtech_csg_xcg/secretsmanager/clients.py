@@ -4,14 +4,48 @@
 Copyright (c) 2023 by Institute for Infocomm Research (I2R) and GovTech CSG, All Rights Reserved.
 """
 
-import boto3
-from aws_secretsmanager_caching import SecretCache, SecretCacheConfig
+import threading
+
 from botocore.exceptions import BotoCoreError, ClientError
 
+from govtech_csg_xcg.secretsmanager import logger
+
+# Keys of the config dict that are passed on to SecretsManager.__init__.
+_CONFIG_KEYS = (
+    "region_name",
+    "aws_access_key_id",
+    "aws_secret_access_key",
+    "aws_session_token",
+    "profile_name",
+)
+
+# Maximum number of secret IDs accepted by a single BatchGetSecretValue call.
+_BATCH_GET_SECRET_VALUE_MAX_IDS = 20
+
+# Options for the botocore Config used by all clients. TCP keep-alive keeps
+# connections to AWS Secrets Manager open between calls, so that each call
+# does not have to pay for a new TCP and TLS handshake. The adaptive retry mode
+# retries throttling errors and 5XX responses with jittered exponential backoff,
+# and additionally rate limits the client itself while it is being throttled.
+_CLIENT_CONFIG_OPTIONS = {
+    "tcp_keepalive": True,
+    "retries": {"mode": "adaptive", "max_attempts": 5},
+}
+
+# Cache of (session, client) tuples, keyed by the arguments used to create them.
+_CLIENT_CACHE = {}
+_CLIENT_CACHE_LOCK = threading.Lock()
+
+# Shared CacheSecretsManager instances, see CacheSecretsManager.get_or_create.
+_CACHE_SECRETS_MANAGERS = {}
+_CACHE_SECRETS_MANAGERS_LOCK = threading.Lock()
+
 
 class SecretsManager:
     """Wrapper class around the AWS Secrets Manager client from boto3."""
 
+    __slots__ = ("_session", "_client")
+
     def __init__(
         self,
         region_name: str = None,
@@ -19,44 +53,87 @@ class SecretsManager:
         aws_secret_access_key: str = None,
         aws_session_token: str = None,
         profile_name: str = None,
+        use_botocore_only: bool = False,
     ):
-        try:
-            self._session = boto3.session.Session(
-                region_name=region_name,
-                aws_access_key_id=aws_access_key_id,
-                aws_secret_access_key=aws_secret_access_key,
-                aws_session_token=aws_session_token,
-                profile_name=profile_name,
-            )
-            self._client = self._session.client("secretsmanager")
-        except BotoCoreError as err:
-            # NOTE: Refer to link below for description of all the Botocore static exceptions
-            # https://github.com/boto/botocore/blob/develop/botocore/exceptions.py
-            #
-            # We raise from None to disable exception chaining:
-            # https://docs.python.org/3/tutorial/errors.html#exception-chaining
-            raise ConfigurationError(
-                f"Configuration error when initializing XCG {self.__class__.__name__}: {err}"
-            ) from None
-
-        if self._session.get_credentials() is None:
-            raise ConfigurationError(
-                f"Could not find AWS credentials when initializing XCG {self.__class__.__name__}"
-            ) from None
+        # Sessions and clients are shared between instances with the same configuration,
+        # so that e.g. multiple DB backends reuse a single pool of HTTPS connections.
+        cache_key = (
+            region_name,
+            aws_access_key_id,
+            aws_secret_access_key,
+            aws_session_token,
+            profile_name,
+            use_botocore_only,
+        )
+        with _CLIENT_CACHE_LOCK:
+            if cache_key not in _CLIENT_CACHE:
+                # boto3 and botocore take a significant amount of time to import, so
+                # we only import them once a client is actually needed. This keeps
+                # e.g. Django management commands that never retrieve secrets fast.
+                from botocore.config import Config
+
+                try:
+                    if use_botocore_only:
+                        # A plain botocore session is enough to create a client, and
+                        # skips the setup of boto3's resource layer.
+                        import botocore.session
+
+                        session = botocore.session.Session(profile=profile_name)
+                        if (
+                            aws_access_key_id
+                            or aws_secret_access_key
+                            or aws_session_token
+                        ):
+                            session.set_credentials(
+                                aws_access_key_id,
+                                aws_secret_access_key,
+                                aws_session_token,
+                            )
+                        client = session.create_client(
+                            "secretsmanager",
+                            region_name=region_name,
+                            config=Config(**_CLIENT_CONFIG_OPTIONS),
+                        )
+                    else:
+                        import boto3
+
+                        session = boto3.session.Session(
+                            region_name=region_name,
+                            aws_access_key_id=aws_access_key_id,
+                            aws_secret_access_key=aws_secret_access_key,
+                            aws_session_token=aws_session_token,
+                            profile_name=profile_name,
+                        )
+                        client = session.client(
+                            "secretsmanager", config=Config(**_CLIENT_CONFIG_OPTIONS)
+                        )
+                except BotoCoreError as err:
+                    # NOTE: Refer to link below for description of all the Botocore static exceptions
+                    # https://github.com/boto/botocore/blob/develop/botocore/exceptions.py
+                    #
+                    # We raise from None to disable exception chaining:
+                    # https://docs.python.org/3/tutorial/errors.html#exception-chaining
+                    raise ConfigurationError(
+                        f"Configuration error when initializing XCG {self.__class__.__name__}: {err}"
+                    ) from None
+                _CLIENT_CACHE[cache_key] = (session, client)
+
+            self._session, self._client = _CLIENT_CACHE[cache_key]
+
+            if self._session.get_credentials() is None:
+                # Don't keep a session around that cannot be used.
+                del _CLIENT_CACHE[cache_key]
+                raise ConfigurationError(
+                    f"Could not find AWS credentials when initializing XCG {self.__class__.__name__}"
+                ) from None
 
     @classmethod
-    def init_from_config_dict(cls, config_dict: dict):
+    def init_from_config_dict(cls, config_dict: dict, **kwargs):
         # We provide this class method as a convenience
         # method for the middleware and DB backends, who
         # rely on similar methods of configuration (i.e.
         # using a dict containing config values).
-        return cls(
-            region_name=config_dict.get("region_name"),
-            aws_access_key_id=config_dict.get("aws_access_key_id"),
-            aws_secret_access_key=config_dict.get("aws_secret_access_key"),
-            aws_session_token=config_dict.get("aws_session_token"),
-            profile_name=config_dict.get("profile_name"),
-        )
+        return cls(**{key: config_dict.get(key) for key in _CONFIG_KEYS}, **kwargs)
 
     def get_secret_string(self, secret_name: str, version_stage: str = None):
         """Returns a secret string for a given AWS Secrets Manager secret.
@@ -99,6 +176,78 @@ class SecretsManager:
 
         return response["SecretString"]
 
+    def get_secret_strings(self, secret_names, version_stage: str = None):
+        """Returns the secret strings for multiple AWS Secrets Manager secrets.
+
+        Where possible, the secrets are retrieved using the BatchGetSecretValue API, which
+        returns up to 20 secrets per call instead of requiring one GetSecretValue call per secret.
+
+        Args:
+            secret_names: Iterable of strings that identify the secrets to be retrieved. Each
+                string can take any of the forms accepted by get_secret_string.
+            version_stage: String that identifies the staging label of the secret values to be retrieved.
+                Possible values are "AWSPREVIOUS", "AWSCURRENT", and "AWSPENDING". Default is "AWSCURRENT".
+
+        Returns:
+            A dict mapping each of the given secret names to its secret string.
+
+        Raises:
+            SecretRetrievalError: Raised if any errors occur while attempting to retrieve any of the
+                secrets from AWS Secrets Manager.
+        """
+        secret_names = list(dict.fromkeys(secret_names))
+
+        # BatchGetSecretValue only returns the AWSCURRENT version of each secret, and is
+        # not available in older versions of botocore. Fall back to individual calls then.
+        if (
+            version_stage not in (None, "AWSCURRENT")
+            or not hasattr(self._client, "batch_get_secret_value")
+            or len(secret_names) <= 1
+        ):
+            return {
+                secret_name: self.get_secret_string(
+                    secret_name, version_stage=version_stage
+                )
+                for secret_name in secret_names
+            }
+
+        secret_strings = {}
+        for i in range(0, len(secret_names), _BATCH_GET_SECRET_VALUE_MAX_IDS):
+            chunk = secret_names[i : i + _BATCH_GET_SECRET_VALUE_MAX_IDS]
+            try:
+                response = self._client.batch_get_secret_value(SecretIdList=chunk)
+            except ClientError as err:
+                code = err.response["Error"]["Code"]
+                msg = err.response["Error"]["Message"]
+                raise SecretRetrievalError(
+                    f"Error occurred while retrieving secrets {chunk}: {code} - {msg}"
+                ) from None
+
+            if response.get("Errors"):
+                error = response["Errors"][0]
+                raise SecretRetrievalError(
+                    f'Error occurred while retrieving secret "{error.get("SecretId")}": '
+                    f'{error.get("ErrorCode")} - {error.get("Message")}'
+                )
+
+            # The caller may have identified each secret by its name, full ARN or
+            # partial ARN, so we index the returned values by all three forms.
+            secret_values = {}
+            for secret_value in response.get("SecretValues", []):
+                arn = secret_value["ARN"]
+                for key in (arn, arn.rsplit(":", 1)[-1], secret_value["Name"]):
+                    secret_values[key] = secret_value
+
+            for secret_name in chunk:
+                secret_value = secret_values.get(secret_name, {})
+                if "SecretString" not in secret_value:
+                    raise SecretRetrievalError(
+                        f"Unable to obtain secret string for {secret_name}"
+                    )
+                secret_strings[secret_name] = secret_value["SecretString"]
+
+        return secret_strings
+
     def get_previous_secret_string(self, secret_name: str):
         return self.get_secret_string(secret_name, version_stage="AWSPREVIOUS")
 
@@ -106,13 +255,32 @@ class SecretsManager:
 class CacheSecretsManager(SecretsManager):
     """Wrapper class around the AWS Secrets Manager client from boto3."""
 
-    def __init__(self, refresh_interval: int = 3600, **kwargs):
+    __slots__ = ("_secret_cache", "_access_count", "_access_counts")
+
+    def __init__(
+        self, refresh_interval: int = 3600, access_count: int = None, **kwargs
+    ):
         super().__init__(**kwargs)
         self._configure_secret_cache(refresh_interval)
 
+        # If set, every access_count-th read of a secret forces a refresh, in
+        # addition to the regular time-based refresh by the underlying cache.
+        if access_count is not None and (
+            not isinstance(access_count, int)
+            or isinstance(access_count, bool)
+            or access_count < 1
+        ):
+            raise ConfigurationError(
+                f"access_count must be a positive integer when initializing XCG {self.__class__.__name__}"
+            )
+        self._access_count = access_count
+        self._access_counts = {}
+
     def _configure_secret_cache(self, refresh_interval):
         # Note: This hidden method is not meant to be called by client code
         # as it will reset the existing cache, which may not be the intended effect.
+        from aws_secretsmanager_caching import SecretCache, SecretCacheConfig
+
         secret_cache_config = SecretCacheConfig(
             secret_refresh_interval=refresh_interval
         )
@@ -121,12 +289,36 @@ class CacheSecretsManager(SecretsManager):
         )
 
     @classmethod
-    def init_from_config_dict(cls, config_dict: dict):
-        cache_secrets_manager = super().init_from_config_dict(config_dict)
-        cache_secrets_manager._configure_secret_cache(
-            config_dict.get("refresh_interval", 3600)
+    def init_from_config_dict(cls, config_dict: dict, **kwargs):
+        return cls(
+            refresh_interval=config_dict.get("refresh_interval", 3600),
+            access_count=config_dict.get("access_count"),
+            **{key: config_dict.get(key) for key in _CONFIG_KEYS},
+            **kwargs,
         )
-        return cache_secrets_manager
+
+    @classmethod
+    def get_or_create(cls, config_dict: dict):
+        """Returns a shared instance configured from the given config dict.
+
+        Instances are shared between all callers with the same configuration, so that
+        e.g. multiple DB backends share one secret cache instead of each creating their own.
+
+        Raises:
+            ConfigurationError: Raised if a new instance has to be created and fails to initialize.
+        """
+        cache_key = (
+            cls,
+            *(config_dict.get(key) for key in _CONFIG_KEYS),
+            config_dict.get("refresh_interval", 3600),
+            config_dict.get("access_count"),
+        )
+        with _CACHE_SECRETS_MANAGERS_LOCK:
+            if cache_key not in _CACHE_SECRETS_MANAGERS:
+                _CACHE_SECRETS_MANAGERS[cache_key] = cls.init_from_config_dict(
+                    config_dict
+                )
+            return _CACHE_SECRETS_MANAGERS[cache_key]
 
     def get_secret_string(
         self, secret_name: str, version_stage: str = None, force_refresh: bool = False
@@ -140,7 +332,9 @@ class CacheSecretsManager(SecretsManager):
             version_stage: String that identifies the staging label of the secret value to be retrieved.
                 Possible values are "AWSPREVIOUS", "AWSCURRENT", and "AWSPENDING". Default is "AWSCURRENT".
             force_refresh: Boolean value that indicates whether or not to force a refresh before the
-                regular refresh interval.
+                regular refresh interval. A refresh is also attempted on every access_count-th read of
+                the secret if access_count was configured, but unlike a forced refresh, the cached
+                value is returned if that refresh fails.
 
         Returns:
             A string representing the value of the specified secret. Note that this could be in the
@@ -154,6 +348,27 @@ class CacheSecretsManager(SecretsManager):
             SecretRetrievalError: Raised if any errors occur while attempting to retrieve the secret
                 from AWS Secrets Manager.
         """
+        refresh_for_access_count = False
+        if self._access_count is not None:
+            # Concurrent reads may occasionally be miscounted, which only shifts
+            # the next forced refresh slightly and is not worth a lock.
+            count = self._access_counts.get(secret_name, 0) + 1
+            if force_refresh or count >= self._access_count:
+                refresh_for_access_count = not force_refresh
+                count = 0
+            self._access_counts[secret_name] = count
+
+        if refresh_for_access_count:
+            # Like the time-based refresh of the underlying cache, a refresh that was
+            # only triggered by the access count keeps serving the cached value if it
+            # fails, e.g. during a brief Secrets Manager outage.
+            try:
+                self._refresh_now(secret_name)
+            except (BotoCoreError, ClientError) as err:
+                logger.warning(
+                    f'Unable to refresh secret "{secret_name}", using cached value: {err}'
+                )
+
         try:
             if force_refresh:
                 self._refresh_now(secret_name)
@@ -181,6 +396,36 @@ class CacheSecretsManager(SecretsManager):
 
         return secret_string
 
+    def get_secret_strings(
+        self, secret_names, version_stage: str = None, force_refresh: bool = False
+    ):
+        """Returns the (cached) secret strings for multiple AWS Secrets Manager secrets.
+
+        Unlike SecretsManager.get_secret_strings, each secret is served from the cache
+        so that the refresh interval is respected for every secret.
+
+        Args:
+            secret_names: Iterable of strings that identify the secrets to be retrieved. Each
+                string can take any of the forms accepted by get_secret_string.
+            version_stage: String that identifies the staging label of the secret values to be retrieved.
+                Possible values are "AWSPREVIOUS", "AWSCURRENT", and "AWSPENDING". Default is "AWSCURRENT".
+            force_refresh: Boolean value that indicates whether or not to force a refresh before the
+                regular refresh interval.
+
+        Returns:
+            A dict mapping each of the given secret names to its secret string.
+
+        Raises:
+            SecretRetrievalError: Raised if any errors occur while attempting to retrieve any of the
+                secrets from AWS Secrets Manager.
+        """
+        return {
+            secret_name: self.get_secret_string(
+                secret_name, version_stage=version_stage, force_refresh=force_refresh
+            )
+            for secret_name in dict.fromkeys(secret_names)
+        }
+
     def get_previous_secret_string(self, secret_name: str, force_refresh: bool = False):
         return self.get_secret_string(
             secret_name, version_stage="AWSPREVIOUS", force_refresh=force_refresh
@@ -191,9 +436,30 @@ class CacheSecretsManager(SecretsManager):
         # the value for all versions, not just AWSCURRENT. i.e. If I invoke
         # sm.get_secret_string(name, version_stage='AWSCURRENT', force_refresh=True),
         # the value of 'AWSPREVIOUS' will be refreshed in our cache as well.
+        #
+        # We store the DescribeSecret result and clear the refresh flag ourselves, so that
+        # the following cache read does not describe the secret a second time. Unlike the
+        # cache's own refresh, which swallows errors and keeps serving the stale value, any
+        # error raised here propagates to the caller.
         secret_cache_item = self._secret_cache._get_cached_secret(secret_name)
-        secret_cache_item._refresh_needed = True
-        secret_cache_item._execute_refresh()
+        with secret_cache_item._lock:
+            secret_cache_item._set_result(secret_cache_item._execute_refresh())
+            secret_cache_item._refresh_needed = False
+            secret_cache_item._exception = None
+            secret_cache_item._exception_count = 0
+
+
+def clear_caches():
+    """Discards all shared boto3/botocore clients and CacheSecretsManager instances.
+
+    Clients created afterwards start from scratch, e.g. to pick up AWS credentials that
+    were rotated in the configuration, or to isolate tests from each other. Existing
+    instances are not affected and keep using the client and cache they already hold.
+    """
+    with _CLIENT_CACHE_LOCK:
+        _CLIENT_CACHE.clear()
+    with _CACHE_SECRETS_MANAGERS_LOCK:
+        _CACHE_SECRETS_MANAGERS.clear()
 
 
 class ConfigurationError(Exception):
@@ -4,7 +4,7 @@
 Copyright (c) 2023 by Institute for Infocomm Research (I2R) and GovTech CSG, All Rights Reserved.
 """
 
-import json
+from concurrent.futures import ThreadPoolExecutor
 
 from django.core.exceptions import ImproperlyConfigured
 from django.db import DatabaseError
@@ -15,10 +15,32 @@ from govtech_csg_xcg.secretsmanager.clients import (
     SecretRetrievalError,
 )
 
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+# Mapping of Django settings dict keys to the keys of the secret stored in AWS Secrets
+# Manager, and whether the key is required to be present in the secret.
+_FIELD_MAP = (
+    ("USER", "username", True),
+    ("PASSWORD", "password", True),
+    ("HOST", "host", True),
+    ("NAME", "dbname", False),
+)
+
 
 class DatabaseCredentials:
     """Class that represents DB credentials retrieved from AWS Secrets Manager."""
 
+    __slots__ = (
+        "secret_arn",
+        "cache_secrets_manager",
+        "_cached_secret_json",
+        "_cached_default_port",
+        "_cached_settings",
+    )
+
     def __init__(self, config_dict):
         secret_arn = config_dict.get("secret_arn")
         if not secret_arn:
@@ -28,32 +50,88 @@ class DatabaseCredentials:
         self.secret_arn = secret_arn
 
         try:
-            self.cache_secrets_manager = CacheSecretsManager.init_from_config_dict(
-                config_dict
-            )
+            self.cache_secrets_manager = CacheSecretsManager.get_or_create(config_dict)
         except ConfigurationError as err:
             raise ImproperlyConfigured(
                 f"Missing or invalid database configuration value(s): {err}"
             ) from None
 
+        # The last secret string retrieved, together with the settings derived from it.
+        # The cache returns the same string object until the secret is refreshed, which
+        # allows us to skip parsing the JSON on every new connection.
+        self._cached_secret_json = None
+        self._cached_default_port = None
+        self._cached_settings = None
+
     def fill_settings_dict(self, settings_dict, default_port, force_refresh=False):
         try:
             secret_json = self.cache_secrets_manager.get_secret_string(
                 self.secret_arn, force_refresh=force_refresh
             )
-            secret_dict = json.loads(secret_json)
         except SecretRetrievalError as err:
             raise DatabaseError(
                 f"Could not retrieve values of database connection parameters from Secrets Manager: {err}"
             ) from None
 
-        settings_dict["USER"] = secret_dict["username"]
-        settings_dict["PASSWORD"] = secret_dict["password"]
-        settings_dict["HOST"] = secret_dict["host"]
-        settings_dict["PORT"] = (
-            int(secret_dict["port"]) if "port" in secret_dict else default_port
-        )
-        settings_dict["NAME"] = secret_dict.get("dbname")
+        if (
+            secret_json is not self._cached_secret_json
+            or default_port != self._cached_default_port
+        ):
+            secret_dict = _json.loads(secret_json)
+            self._cached_settings = {
+                settings_key: (
+                    secret_dict[secret_key] if required else secret_dict.get(secret_key)
+                )
+                for settings_key, secret_key, required in _FIELD_MAP
+            }
+            # The port is handled separately since its default depends on the backend.
+            self._cached_settings["PORT"] = (
+                int(secret_dict["port"]) if "port" in secret_dict else default_port
+            )
+            self._cached_secret_json = secret_json
+            self._cached_default_port = default_port
+
+        # We always write the values, rather than skipping this when nothing has changed,
+        # since other code (e.g. Django's test runner) may modify the settings dict too.
+        settings_dict.update(self._cached_settings)
+
+
+def prefetch_database_credentials(db_credentials, max_workers=8):
+    """Retrieves the secrets for multiple DatabaseCredentials concurrently.
+
+    Each DatabaseCredentials normally retrieves its secret the first time a connection
+    is made, so N databases cost N sequential round trips to AWS Secrets Manager. This
+    function retrieves all of them in parallel instead, populating each of their caches.
+
+    Args:
+        db_credentials: Iterable of DatabaseCredentials whose secrets should be retrieved.
+        max_workers: Maximum number of threads used to retrieve the secrets.
+
+    Raises:
+        DatabaseError: Raised if any of the secrets could not be retrieved. The error is for the
+            first failed secret in the order given. Retrieval of the other secrets is not
+            cancelled; all of them run to completion before the error is raised.
+    """
+    db_credentials = list(db_credentials)
+    if not db_credentials:
+        return
+
+    with ThreadPoolExecutor(
+        max_workers=min(max_workers, len(db_credentials))
+    ) as executor:
+        futures = [
+            executor.submit(
+                creds.cache_secrets_manager.get_secret_string, creds.secret_arn
+            )
+            for creds in db_credentials
+        ]
+        try:
+            for future in futures:
+                future.result()
+        except SecretRetrievalError as err:
+            raise DatabaseError(
+                f"Could not retrieve values of database connection parameters from Secrets Manager: {err}"
+            ) from None
 
 
 class ConnectionError(Exception):
@@ -4,7 +4,7 @@
 Copyright (c) 2023 by Institute for Infocomm Research (I2R) and GovTech CSG, All Rights Reserved.
 """
 
-import json
+import threading
 import time
 
 from django.conf import settings
@@ -18,6 +18,11 @@ from govtech_csg_xcg.secretsmanager.clients import (
     SecretsManager,
 )
 
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
 
 class SecretKeyRefreshMiddleware(MiddlewareMixin):
     """Middleware that periodically updates Django's secret key from AWS Secrets Manager."""
@@ -48,14 +53,24 @@ class SecretKeyRefreshMiddleware(MiddlewareMixin):
         self.secret_keyname = secret_keyname
 
         try:
-            self.secrets_manager = SecretsManager.init_from_config_dict(config_dict)
+            # The middleware only needs a single client, so we skip creating a full boto3 session.
+            self.secrets_manager = SecretsManager.init_from_config_dict(
+                config_dict, use_botocore_only=True
+            )
         except ConfigurationError as err:
             raise ImproperlyConfigured(
                 f"Error configuring SecretsManager for XCG secret key refresh middleware: {err}"
             ) from None
 
         self.refresh_interval = config_dict.get("refresh_interval", 3600)
-        self.last_refreshed_time = time.time()
+        self.last_refreshed_time = time.monotonic()
+        self.next_refresh_time = self.last_refreshed_time + self.refresh_interval
+
+        # If enabled, the secret key is refreshed in a separate thread so that the
+        # request which triggers the refresh does not have to wait on AWS.
+        self.refresh_in_background = config_dict.get("refresh_in_background", False)
+        self._refresh_lock = threading.Lock()
+        self._refresh_thread = None
 
     def __call__(self, request):
         self.process_request(request)
@@ -63,63 +78,88 @@ class SecretKeyRefreshMiddleware(MiddlewareMixin):
         return response
 
     def process_request(self, request):
-        current_time = time.time()
-        if current_time - self.last_refreshed_time >= self.refresh_interval:
-            # We set this early so as to fail transparently and not
-            # cause repeated attempts at retrieving the secret if an
-            # error is encountered.
-            self.last_refreshed_time = current_time
-            logger.info("Attempting to refresh Django secret key")
-            try:
-                secret_string = self.secrets_manager.get_secret_string(self.secret_arn)
-                retrieved_secret_key = json.loads(secret_string)[self.secret_keyname]
-            # We log and suppress the error here rather than propagate
-            # upwards so as to not show the user a 5XX HTTP error if
-            # this fails, since secret key refresh is not critical
-            # to the functionality of the application. However, we
-            # still log the error so that devs can be alerted.
-            except SecretRetrievalError as err:
-                logger.error(
-                    f"Unable to retrieve Django secret key from Secrets Manager: {err}"
-                )
-                return
-            except json.JSONDecodeError:
-                logger.error(
-                    "Unable to load Secrets Manager secret string as Python dict"
-                )
-                return
-            except KeyError:
-                logger.error(
-                    "Unable to find DJANGO_SECRET_KEY in Secrets Manager secret dict"
+        # We use a monotonic clock so that adjustments to the system
+        # clock cannot cause refreshes to happen early or late.
+        current_time = time.monotonic()
+        if current_time < self.next_refresh_time:
+            return
+
+        # Only one refresh may be in progress at any time. Other requests
+        # simply carry on using the current secret key in the meantime.
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+
+        # We set this early so as to fail transparently and not
+        # cause repeated attempts at retrieving the secret if an
+        # error is encountered.
+        self.last_refreshed_time = current_time
+        self.next_refresh_time = current_time + self.refresh_interval
+
+        if self.refresh_in_background:
+            self._refresh_thread = threading.Thread(
+                target=self._refresh_secret_key_and_release_lock, daemon=True
+            )
+            self._refresh_thread.start()
+        else:
+            self._refresh_secret_key_and_release_lock()
+
+    def _refresh_secret_key_and_release_lock(self):
+        try:
+            self._refresh_secret_key()
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh_secret_key(self):
+        logger.info("Attempting to refresh Django secret key")
+        try:
+            secret_string = self.secrets_manager.get_secret_string(self.secret_arn)
+            retrieved_secret_key = _json.loads(secret_string)[self.secret_keyname]
+        # We log and suppress the error here rather than propagate
+        # upwards so as to not show the user a 5XX HTTP error if
+        # this fails, since secret key refresh is not critical
+        # to the functionality of the application. However, we
+        # still log the error so that devs can be alerted.
+        except SecretRetrievalError as err:
+            logger.error(
+                f"Unable to retrieve Django secret key from Secrets Manager: {err}"
+            )
+            return
+        # Both json.JSONDecodeError and orjson.JSONDecodeError subclass ValueError.
+        except ValueError:
+            logger.error("Unable to load Secrets Manager secret string as Python dict")
+            return
+        except KeyError:
+            logger.error(
+                "Unable to find DJANGO_SECRET_KEY in Secrets Manager secret dict"
+            )
+            return
+        else:
+            logger.info("Retrieved Django secret key from Secrets Manager")
+
+        if retrieved_secret_key != settings.SECRET_KEY:
+            logger.info("Django secret key changed, attempting to rotate")
+            # In the case where the secret key in Secrets Manager is changed,
+            # we need to gracefully rotate out the current key by placing it
+            # into settings.SECRET_KEY_FALLBACKS. This feature is only supported
+            # for Django 4.1 and later, and users don't need to explicitly
+            # initialise it with an empty list. See link below:
+            # https://docs.djangoproject.com/en/4.1/ref/settings/#secret-key-fallbacks
+            if hasattr(settings, "SECRET_KEY_FALLBACKS"):
+                # We only allow for one fallback key at a time.
+                # This is to prevent accumulation of many fallback
+                # keys over time, which will affect performance since
+                # each key has to be tried one by one.
+                settings.SECRET_KEY_FALLBACKS = [settings.SECRET_KEY]
+                logger.info(
+                    "Added old Django secret key to settings.SECRET_KEY_FALLBACKS"
                 )
-                return
             else:
-                logger.info("Retrieved Django secret key from Secrets Manager")
-
-            if retrieved_secret_key != settings.SECRET_KEY:
-                logger.info("Django secret key changed, attempting to rotate")
-                # In the case where the secret key in Secrets Manager is changed,
-                # we need to gracefully rotate out the current key by placing it
-                # into settings.SECRET_KEY_FALLBACKS. This feature is only supported
-                # for Django 4.1 and later, and users don't need to explicitly
-                # initialise it with an empty list. See link below:
-                # https://docs.djangoproject.com/en/4.1/ref/settings/#secret-key-fallbacks
-                if hasattr(settings, "SECRET_KEY_FALLBACKS"):
-                    # We only allow for one fallback key at a time.
-                    # This is to prevent accumulation of many fallback
-                    # keys over time, which will affect performance since
-                    # each key has to be tried one by one.
-                    settings.SECRET_KEY_FALLBACKS = [settings.SECRET_KEY]
-                    logger.info(
-                        "Added old Django secret key to settings.SECRET_KEY_FALLBACKS"
-                    )
-                else:
-                    logger.warning(
-                        "settings.SECRET_KEY_FALLBACKS does not exist; "
-                        "Proceeding with rotation without fallback"
-                    )
-
-                settings.SECRET_KEY = retrieved_secret_key
-                logger.info("Changed to new Django secret key from Secrets Manager")
-            else:
-                logger.info("Django secret key not changed, no rotation needed")
+                logger.warning(
+                    "settings.SECRET_KEY_FALLBACKS does not exist; "
+                    "Proceeding with rotation without fallback"
+                )
+
+            settings.SECRET_KEY = retrieved_secret_key
+            logger.info("Changed to new Django secret key from Secrets Manager")
+        else:
+            logger.info("Django secret key not changed, no rotation needed")
@@ -3,15 +3,17 @@
 # Unset these environment variables to start from a clean slate.
 unset AWS_ENDPOINT_URL AWS_ENDPOINT_URL_SECRETS_MANAGER
 
-# First run the tests for the SecretsManager and CacheSecretsManager clients.
-echo -e "Running tests for SecretsManager and CacheSecretsManager clients\n"
-python3 manage.py test testapp.tests.test_clients --noinput
+# First run the tests for the SecretsManager and CacheSecretsManager clients, and the shared DB helpers.
+echo -e "Running tests for SecretsManager and CacheSecretsManager clients, and shared DB helpers\n"
+# These tests use moto's in-process mock, so their test cases can run in parallel worker processes.
+python3 manage.py test testapp.tests.test_clients testapp.tests.test_db_common --noinput --parallel
 
 # Next run the tests for the MySQL and PostgreSQL database backends, as well as the secrets refresh middleware.
 echo -e "\nRunning tests for database backends and secrets refresh middleware\n"
 
 # These tests require the moto server to be running first, and for the DB secrets to be created
-# before tests are run so that Django initialization does not fail.
+# before tests are run so that Django initialization does not fail. They run serially, since
+# they share the moto server's recorder, which records the calls of every worker process.
 moto_server > /dev/null 2>&1 &
 export AWS_ENDPOINT_URL_SECRETS_MANAGER=http://localhost:5000
 python3 create_db_secrets.py
@@ -1,15 +1,19 @@
 import json
 import os
+import subprocess
+import sys
 import unittest
+from unittest.mock import patch
 
 import boto3
 from moto import mock_secretsmanager
-from parameterized import parameterized_class
 
 from govtech_csg_xcg.secretsmanager.clients import (
     CacheSecretsManager,
+    ConfigurationError,
     SecretRetrievalError,
     SecretsManager,
+    clear_caches,
 )
 
 # Set up dummy AWS credentials to prevent accidental mutation of real infrastructure
@@ -20,108 +24,164 @@ os.environ["AWS_SESSION_TOKEN"] = "testing"
 os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
 
 
-@parameterized_class(
-    "client_attr_name",
-    [
-        ("sm",),
-        ("cache_sm",),
-    ],
-)
-@mock_secretsmanager
-class TestSecretsRetrieval(unittest.TestCase):
-    """Test case for both the SecretsManager and CacheSecretsManager class.
+class _SecretsRetrievalTests:
+    """Tests common to both the SecretsManager and CacheSecretsManager class.
 
-    This test case focuses on basic secrets retrieval functionality that is common
-    to both classes. The tests below have been parameterized so as to minimize duplication.
+    This mixin focuses on basic secrets retrieval functionality that is common
+    to both classes. Subclasses set client_cls to the client class under test.
     """
 
-    def setUp(self):
+    client_cls = None
+    client_kwargs = {}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # The tests in this mixin only read secrets, so the mock AWS state is
+        # created once per class rather than once per test. We start and stop the
+        # mock ourselves since @mock_secretsmanager only patches test methods.
+        cls.mock = mock_secretsmanager()
+        cls.mock.start()
+        cls.boto3_client = boto3.client("secretsmanager")
+
         # Create a secret and update its value to create current and previous versions.
-        self.boto3_client = boto3.client("secretsmanager")
-        response = self.boto3_client.create_secret(
+        response = cls.boto3_client.create_secret(
             Name="test-secret",
             SecretString=json.dumps({"value": "previous-test-secret-string"}),
         )
-        self.boto3_client.put_secret_value(
+        cls.boto3_client.put_secret_value(
             SecretId=response["ARN"],
             SecretString=json.dumps({"value": "test-secret-string"}),
         )
+        cls.boto3_client.create_secret(
+            Name="test-secret-2",
+            SecretString=json.dumps({"value": "test-secret-string-2"}),
+        )
+        cls.boto3_client.create_secret(
+            Name="test-secret-with-no-previous-version",
+            SecretString=json.dumps({"value": "test-secret-string"}),
+        )
+        cls.boto3_client.create_secret(
+            Name="test-binary-secret",
+            SecretBinary=b"test-secret-bytes",
+        )
+        response = cls.boto3_client.create_secret(
+            Name="test-secret-with-previous-binary-version",
+            SecretBinary=b"previous-test-secret-bytes",
+        )
+        cls.boto3_client.put_secret_value(
+            SecretId=response["ARN"],
+            SecretString="test-secret-string",
+        )
 
-        # Instantiate one of each client type for testing.
-        # We will use the parameterized arguments 'sm' and 'cache_sm' to refer to these clients.
-        self.sm = SecretsManager()
-        self.cache_sm = CacheSecretsManager()
+    @classmethod
+    def tearDownClass(cls):
+        cls.mock.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = self.client_cls(**self.client_kwargs)
 
     def test_get_secret_string_returns_correct_string(self):
-        client = self.__dict__[self.client_attr_name]
+        client = self.client
         secret_string = json.loads(client.get_secret_string("test-secret"))["value"]
         self.assertEqual(secret_string, "test-secret-string")
 
     def test_get_previous_secret_string_returns_correct_string(self):
-        client = self.__dict__[self.client_attr_name]
+        client = self.client
         secret_string = json.loads(client.get_previous_secret_string("test-secret"))[
             "value"
         ]
         self.assertEqual(secret_string, "previous-test-secret-string")
 
     def test_get_secret_string_raises_exception_if_not_found(self):
-        client = self.__dict__[self.client_attr_name]
+        client = self.client
         with self.assertRaises(SecretRetrievalError):
             client.get_secret_string("non-existent-secret")
 
+    def test_get_secret_strings_returns_correct_strings(self):
+        client = self.client
+        secret_strings = client.get_secret_strings(["test-secret", "test-secret-2"])
+        self.assertEqual(
+            {name: json.loads(s)["value"] for name, s in secret_strings.items()},
+            {
+                "test-secret": "test-secret-string",
+                "test-secret-2": "test-secret-string-2",
+            },
+        )
+
+    def test_get_secret_strings_raises_exception_if_any_not_found(self):
+        client = self.client
+        with self.assertRaises(SecretRetrievalError):
+            client.get_secret_strings(["test-secret", "non-existent-secret"])
+
     def test_get_previous_secret_string_raises_exception_if_not_found(self):
-        client = self.__dict__[self.client_attr_name]
+        client = self.client
         with self.assertRaises(SecretRetrievalError):
             client.get_previous_secret_string("non-existent-secret")
 
     def test_get_previous_secret_string_raises_exception_if_no_previous_version(self):
-        self.boto3_client.create_secret(
-            Name="test-secret-with-no-previous-version",
-            SecretString=json.dumps({"value": "test-secret-string"}),
-        )
-
-        client = self.__dict__[self.client_attr_name]
+        client = self.client
         with self.assertRaises(SecretRetrievalError):
             client.get_previous_secret_string("test-secret-with-no-previous-version")
 
     def test_get_secret_string_raises_exception_if_not_string(self):
-        self.boto3_client.create_secret(
-            Name="test-binary-secret",
-            SecretBinary=b"test-secret-bytes",
-        )
-
-        client = self.__dict__[self.client_attr_name]
+        client = self.client
         with self.assertRaises(SecretRetrievalError):
             client.get_secret_string("test-binary-secret")
 
     def test_get_previous_secret_string_raises_exception_if_not_string(self):
-        response = self.boto3_client.create_secret(
-            Name="test-binary-secret",
-            SecretBinary=b"previous-test-secret-bytes",
-        )
-        self.boto3_client.put_secret_value(
-            SecretId=response["ARN"],
-            SecretString="test-secret-string",
-        )
-
-        client = self.__dict__[self.client_attr_name]
+        client = self.client
         with self.assertRaises(SecretRetrievalError):
-            client.get_previous_secret_string("test-binary-secret")
+            client.get_previous_secret_string(
+                "test-secret-with-previous-binary-version"
+            )
+
+
+class TestSecretsManagerRetrieval(_SecretsRetrievalTests, unittest.TestCase):
+    """Test case for basic secrets retrieval using the SecretsManager class."""
+
+    client_cls = SecretsManager
+
+
+class TestBotocoreSecretsManagerRetrieval(_SecretsRetrievalTests, unittest.TestCase):
+    """Test case for basic secrets retrieval using a SecretsManager backed by botocore only."""
+
+    client_cls = SecretsManager
+    client_kwargs = {"use_botocore_only": True}
+
+
+class TestCacheSecretsManagerRetrieval(_SecretsRetrievalTests, unittest.TestCase):
+    """Test case for basic secrets retrieval using the CacheSecretsManager class."""
+
+    client_cls = CacheSecretsManager
 
 
-@mock_secretsmanager
 class TestSecretsCaching(unittest.TestCase):
     """Test case for the caching functionality of the CacheSecretsManager class.
 
     This test case focuses on the caching capabilities of CacheSecretsManager.
-    Basic secrets retrieval functionality is included in the TestSecretsRetrieval test case above.
+    Basic secrets retrieval functionality is included in the _SecretsRetrievalTests mixin above.
     """
 
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.mock = mock_secretsmanager()
+        cls.mock.start()
+        cls.boto3_client = boto3.client("secretsmanager")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mock.stop()
+        super().tearDownClass()
+
     def setUp(self):
         # Create a secret and update its value to create current and previous versions.
-        self.boto3_client = boto3.client("secretsmanager")
+        # The tests below update the secret, so each test uses a secret of its own.
+        self.secret_name = self._testMethodName.replace("_", "-")
         response = self.boto3_client.create_secret(
-            Name="test-secret",
+            Name=self.secret_name,
             SecretString=json.dumps({"value": "test-secret-string-1"}),
         )
         self.secret_arn = response["ARN"]
@@ -133,28 +193,36 @@ class TestSecretsCaching(unittest.TestCase):
         self.cache_sm = CacheSecretsManager(refresh_interval=3600)
 
     def test_get_secret_string_caches_value(self):
-        secret_string_before_update = self.cache_sm.get_secret_string("test-secret")
+        secret_string_before_update = self.cache_sm.get_secret_string(self.secret_name)
         self.boto3_client.put_secret_value(
             SecretId=self.secret_arn,
             SecretString=json.dumps({"value": "test-secret-string-3"}),
         )
-        secret_string_after_update = self.cache_sm.get_secret_string("test-secret")
+        secret_string_after_update = self.cache_sm.get_secret_string(self.secret_name)
 
         self.assertEqual(secret_string_before_update, secret_string_after_update)
         self.assertEqual(
             secret_string_after_update, json.dumps({"value": "test-secret-string-2"})
         )
 
+    def test_get_secret_string_returns_same_object_until_refresh(self):
+        # DatabaseCredentials.fill_settings_dict relies on this to skip parsing the secret
+        # JSON again. It holds because the caching library returns deep copies of its
+        # cached values, and copy.deepcopy returns str objects unchanged.
+        secret_string = self.cache_sm.get_secret_string(self.secret_name)
+
+        self.assertIs(self.cache_sm.get_secret_string(self.secret_name), secret_string)
+
     def test_get_previous_secret_string_caches_value(self):
         secret_string_before_update = self.cache_sm.get_previous_secret_string(
-            "test-secret"
+            self.secret_name
         )
         self.boto3_client.put_secret_value(
             SecretId=self.secret_arn,
             SecretString=json.dumps({"value": "test-secret-string-3"}),
         )
         secret_string_after_update = self.cache_sm.get_previous_secret_string(
-            "test-secret"
+            self.secret_name
         )
 
         self.assertEqual(secret_string_before_update, secret_string_after_update)
@@ -163,14 +231,50 @@ class TestSecretsCaching(unittest.TestCase):
         )
 
     def test_get_secret_string_with_force_refresh_updates_cache(self):
-        secret_string_before_update = self.cache_sm.get_secret_string("test-secret")
+        secret_string_before_update = self.cache_sm.get_secret_string(self.secret_name)
         self.boto3_client.put_secret_value(
             SecretId=self.secret_arn,
             SecretString=json.dumps({"value": "test-secret-string-3"}),
         )
         secret_string_after_update = self.cache_sm.get_secret_string(
-            "test-secret", force_refresh=True
+            self.secret_name, force_refresh=True
+        )
+
+        self.assertEqual(
+            secret_string_before_update, json.dumps({"value": "test-secret-string-2"})
+        )
+        self.assertEqual(
+            secret_string_after_update, json.dumps({"value": "test-secret-string-3"})
+        )
+
+    def test_get_secret_string_with_force_refresh_describes_secret_once(self):
+        self.cache_sm.get_secret_string(self.secret_name)
+        client = self.cache_sm._client
+        with patch.object(
+            client, "describe_secret", wraps=client.describe_secret
+        ) as mock_describe_secret:
+            self.cache_sm.get_secret_string(self.secret_name, force_refresh=True)
+
+        self.assertEqual(mock_describe_secret.call_count, 1)
+
+    def test_get_secret_string_with_force_refresh_raises_for_deleted_secret(self):
+        self.cache_sm.get_secret_string(self.secret_name)
+        self.boto3_client.delete_secret(
+            SecretId=self.secret_arn, ForceDeleteWithoutRecovery=True
+        )
+
+        with self.assertRaises(SecretRetrievalError) as ctx:
+            self.cache_sm.get_secret_string(self.secret_name, force_refresh=True)
+        self.assertIn("ResourceNotFoundException", str(ctx.exception))
+
+    def test_get_secret_string_with_access_count_refreshes_after_count_reached(self):
+        cache_sm = CacheSecretsManager(refresh_interval=3600, access_count=2)
+        secret_string_before_update = cache_sm.get_secret_string(self.secret_name)
+        self.boto3_client.put_secret_value(
+            SecretId=self.secret_arn,
+            SecretString=json.dumps({"value": "test-secret-string-3"}),
         )
+        secret_string_after_update = cache_sm.get_secret_string(self.secret_name)
 
         self.assertEqual(
             secret_string_before_update, json.dumps({"value": "test-secret-string-2"})
@@ -179,16 +283,38 @@ class TestSecretsCaching(unittest.TestCase):
             secret_string_after_update, json.dumps({"value": "test-secret-string-3"})
         )
 
+    def test_get_secret_string_with_access_count_serves_cached_value_if_refresh_fails(
+        self,
+    ):
+        cache_sm = CacheSecretsManager(refresh_interval=3600, access_count=2)
+        secret_string_before_delete = cache_sm.get_secret_string(self.secret_name)
+        self.boto3_client.delete_secret(
+            SecretId=self.secret_arn, ForceDeleteWithoutRecovery=True
+        )
+        with self.assertLogs("secretsmanager", level="WARNING") as logs:
+            secret_string_after_delete = cache_sm.get_secret_string(self.secret_name)
+
+        self.assertEqual(secret_string_after_delete, secret_string_before_delete)
+        self.assertIn("ResourceNotFoundException", logs.output[0])
+
+    def test_init_with_invalid_access_count_raises_configuration_error(self):
+        for access_count in (0, "5", 2.5, True):
+            with self.subTest(access_count=access_count):
+                with self.assertRaises(ConfigurationError):
+                    CacheSecretsManager(
+                        refresh_interval=3600, access_count=access_count
+                    )
+
     def test_get_previous_secret_string_with_force_refresh_updates_cache(self):
         secret_string_before_update = self.cache_sm.get_previous_secret_string(
-            "test-secret"
+            self.secret_name
         )
         self.boto3_client.put_secret_value(
             SecretId=self.secret_arn,
             SecretString=json.dumps({"value": "test-secret-string-3"}),
         )
         secret_string_after_update = self.cache_sm.get_previous_secret_string(
-            "test-secret", force_refresh=True
+            self.secret_name, force_refresh=True
         )
 
         self.assertEqual(
@@ -197,3 +323,119 @@ class TestSecretsCaching(unittest.TestCase):
         self.assertEqual(
             secret_string_after_update, json.dumps({"value": "test-secret-string-2"})
         )
+
+
+@mock_secretsmanager
+class TestBatchSecretsRetrieval(unittest.TestCase):
+    """Test case for the BatchGetSecretValue code path of SecretsManager.get_secret_strings.
+
+    The operation is patched onto the client since it is not available in every
+    supported version of botocore.
+    """
+
+    def setUp(self):
+        self.sm = SecretsManager()
+
+    def test_get_secret_strings_uses_batch_api_in_chunks(self):
+        secret_names = [f"test-secret-{i}" for i in range(25)]
+
+        def batch_get_secret_value(SecretIdList):
+            return {
+                "SecretValues": [
+                    {
+                        "ARN": f"arn:aws:secretsmanager:us-east-1:123456789012:secret:{name}-AbCdEf",
+                        "Name": name,
+                        "SecretString": f"{name}-string",
+                    }
+                    for name in SecretIdList
+                ],
+                "Errors": [],
+            }
+
+        with patch.object(
+            self.sm._client,
+            "batch_get_secret_value",
+            create=True,
+            side_effect=batch_get_secret_value,
+        ) as mock_batch_get:
+            secret_strings = self.sm.get_secret_strings(secret_names)
+
+        self.assertEqual(mock_batch_get.call_count, 2)
+        self.assertEqual(
+            secret_strings, {name: f"{name}-string" for name in secret_names}
+        )
+
+    def test_get_secret_strings_raises_exception_on_batch_errors(self):
+        with patch.object(
+            self.sm._client,
+            "batch_get_secret_value",
+            create=True,
+            return_value={
+                "SecretValues": [],
+                "Errors": [
+                    {
+                        "SecretId": "test-secret-1",
+                        "ErrorCode": "ResourceNotFoundException",
+                        "Message": "Secrets Manager can't find the specified secret.",
+                    }
+                ],
+            },
+        ):
+            with self.assertRaises(SecretRetrievalError):
+                self.sm.get_secret_strings(["test-secret-1", "test-secret-2"])
+
+
+@mock_secretsmanager
+class TestClientReuse(unittest.TestCase):
+    """Test case for the sharing of boto3 clients between client instances."""
+
+    def tearDown(self):
+        clear_caches()
+
+    def test_instances_with_same_config_share_boto3_client(self):
+        sm = SecretsManager(region_name="us-east-1")
+        cache_sm = CacheSecretsManager(region_name="us-east-1")
+        self.assertIs(sm._client, cache_sm._client)
+
+    def test_instances_with_different_config_use_separate_boto3_clients(self):
+        sm = SecretsManager(region_name="us-east-1")
+        other_sm = SecretsManager(region_name="ap-southeast-1")
+        self.assertIsNot(sm._client, other_sm._client)
+
+    def test_get_or_create_returns_shared_instance_for_same_config(self):
+        config_dict = {"region_name": "us-east-1", "refresh_interval": 1800}
+        cache_sm = CacheSecretsManager.get_or_create(config_dict)
+        self.assertIs(cache_sm, CacheSecretsManager.get_or_create(dict(config_dict)))
+
+    def test_get_or_create_returns_separate_instances_for_different_config(self):
+        cache_sm = CacheSecretsManager.get_or_create({"refresh_interval": 1800})
+        other_cache_sm = CacheSecretsManager.get_or_create({"refresh_interval": 900})
+        self.assertIsNot(cache_sm, other_cache_sm)
+
+    def test_clear_caches_discards_shared_clients_and_instances(self):
+        config_dict = {"region_name": "us-east-1", "refresh_interval": 1800}
+        cache_sm = CacheSecretsManager.get_or_create(config_dict)
+        clear_caches()
+        new_cache_sm = CacheSecretsManager.get_or_create(config_dict)
+
+        self.assertIsNot(cache_sm, new_cache_sm)
+        self.assertIsNot(cache_sm._client, new_cache_sm._client)
+
+
+class TestLazyImports(unittest.TestCase):
+    """Test case for the lazy import of boto3 and aws_secretsmanager_caching."""
+
+    def test_importing_clients_does_not_import_boto3(self):
+        # A fresh interpreter is needed, since other tests have already imported boto3.
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys; import govtech_csg_xcg.secretsmanager.clients; "
+                "print(sorted({'boto3', 'aws_secretsmanager_caching'} & set(sys.modules)))",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        self.assertEqual(result.stdout.strip(), "[]")
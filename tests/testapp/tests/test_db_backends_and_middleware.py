@@ -1,17 +1,23 @@
+import atexit
+import contextlib
+import functools
 import json
 import logging
 import os
+import threading
 import time
 import unittest
 from datetime import datetime, timedelta
 from unittest.mock import Mock, patch
 
 import boto3
-import requests
+import urllib3
 from django.conf import settings
-from django.db import close_old_connections
-from django.test import Client
-from parameterized import parameterized_class
+from django.db import connections
+from django.http import HttpResponse
+from django.test import Client, SimpleTestCase
+
+from govtech_csg_xcg.secretsmanager.middleware import SecretKeyRefreshMiddleware
 
 # Set up dummy AWS credentials to prevent accidental mutation of real infrastructure
 os.environ["AWS_ACCESS_KEY_ID"] = "testing"
@@ -20,53 +26,159 @@ os.environ["AWS_SECURITY_TOKEN"] = "testing"
 os.environ["AWS_SESSION_TOKEN"] = "testing"
 os.environ["AWS_DEFAULT_REGION"] = "ap-southeast-1"
 
-SESSION = requests.Session()
+MOTO_SERVER_URL = "http://localhost:5000"
+MOTO_RECORDER_URL = f"{MOTO_SERVER_URL}/moto-api/recorder"
+
+# All calls to the moto recorder reuse a single keep-alive connection to the moto server.
+HTTP = urllib3.PoolManager(
+    num_pools=1,
+    maxsize=4,
+    retries=False,
+    headers={"Connection": "keep-alive", "Accept-Encoding": "identity"},
+)
+
+# Length of the moto recorder's log that has already been returned by stop_moto_recording(),
+# or None if the recorder has not been reset by this process yet.
+_recording_offset = None
 
 
-def start_moto_recording():
-    """Start the moto recorder service, which records API calls to the mock AWS API server."""
-    SESSION.post("http://localhost:5000/moto-api/recorder/reset-recording")
-    SESSION.post("http://localhost:5000/moto-api/recorder/start-recording")
+@functools.lru_cache(maxsize=4)
+def _sm_client(endpoint_url=MOTO_SERVER_URL):
+    """Return a boto3 Secrets Manager client for the given endpoint, creating it on first use."""
+    return boto3.client("secretsmanager", endpoint_url=endpoint_url)
+
+
+@functools.lru_cache(maxsize=None)
+def ensure_django_secret_key_secret():
+    """Create the secret holding the new Django secret key in moto, once per process.
+
+    The secret is deleted when the process exits. If it already exists (e.g. it was created
+    by another test process), it is left for its creator to clean up.
+    """
+    client = _sm_client()
+    try:
+        client.create_secret(
+            Name="test-django-secret-key",
+            SecretString=json.dumps({"DJANGO_SECRET_KEY": settings.NEW_SECRET_KEY}),
+        )
+    except client.exceptions.ResourceExistsException:
+        return
+    atexit.register(
+        client.delete_secret,
+        SecretId="test-django-secret-key",
+        ForceDeleteWithoutRecovery=True,
+    )
+
+
+def start_moto_recording(reset=False):
+    """Start the moto recorder service, which records API calls to the mock AWS API server.
+
+    The recorder only ever appends to its log, so it is only reset when asked to, or when
+    its contents are not known yet. Otherwise, stop_moto_recording() skips whatever was
+    already returned by earlier recordings.
+    """
+    global _recording_offset
+    if reset or _recording_offset is None:
+        HTTP.request("POST", f"{MOTO_RECORDER_URL}/reset-recording")
+        _recording_offset = 0
+    HTTP.request("POST", f"{MOTO_RECORDER_URL}/start-recording")
 
 
 def stop_moto_recording():
-    """Stop the moto recorder service and return the log in text form."""
-    SESSION.post("http://localhost:5000/moto-api/recorder/stop-recording")
-    return SESSION.get(
-        "http://localhost:5000/moto-api/recorder/download-recording"
-    ).text
-
-
-@parameterized_class(
-    [
-        {"engine": "mysql"},
-        {"engine": "postgresql"},
-    ]
-)
-class TestDatabaseBackends(unittest.TestCase):
-    """Test case for both the MySQL and PostgreSQL database backends."""
+    """Stop the moto recorder service and return the log of the latest recording in text form."""
+    global _recording_offset
+    HTTP.request("POST", f"{MOTO_RECORDER_URL}/stop-recording")
+    recording = HTTP.request("GET", f"{MOTO_RECORDER_URL}/download-recording").data
+    log = recording[_recording_offset:]
+    _recording_offset = len(recording)
+    return log.decode()
+
+
+@contextlib.contextmanager
+def moto_recording(reset=False):
+    """Record the API calls made to the mock AWS API server within the block.
+
+    Yields a function that stops the recording and returns the log in text form.
+    The recording is always stopped when the block exits, even if the function is never called.
+    """
+    log = None
+
+    def get_log():
+        nonlocal log
+        if log is None:
+            log = stop_moto_recording()
+        return log
+
+    start_moto_recording(reset=reset)
+    try:
+        yield get_log
+    finally:
+        get_log()
+
+
+def _clock(start, bump):
+    """Yield start once, and start + bump for every call after that.
+
+    Used as the side_effect of a mocked clock, so that the first reading (taken when
+    the middleware is set up) is the current time, and every later reading makes it
+    look like the refresh interval has passed, however many times the clock is read.
+    """
+    yield start
+    while True:
+        yield start + bump
+
+
+class _DatabaseBackendTests:
+    """Tests shared by the MySQL and PostgreSQL database backends.
+
+    Each engine gets its own top-level test case below (rather than being generated from
+    a single parameterized class) so that parallel test runners can schedule them
+    independently.
+
+    Note that this is deliberately not a django.test.TransactionTestCase, since that
+    would make Django's test runner create (and flush) test databases for these aliases.
+    The tests instead run against the databases migrated by migrate_all_databases.sh.
+    """
+
+    engine = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # The client (and the handler it builds on its first request) is shared by all the tests
+        cls.client = Client()
+        cls._warmed = False
 
     def setUp(self):
         self.db_alias = f"{self.engine}_test"
-        self.client = Client()
-        self.requests_session = requests.Session()
+        self.client.cookies.clear()
 
-        # Make an initial request to ensure initial secret retrieval has occurred
+    def _ensure_warmed(self):
+        """Make an initial request, if not already done, to ensure initial secret retrieval has occurred."""
+        if type(self)._warmed:
+            return
         self.client.get(f"/{self.engine}/")
-        # Close old connections so that the next DB query will have to
-        # establish a new connection by calling get_connection_params
-        # Normally this would happen automatically, but Django's test
-        # runner purposely doesn't close existing connections (maybe for performance?).
-        close_old_connections()
+        type(self)._warmed = True
+
+    def force_new_connection(self):
+        """Close the DB connection so that the next query has to call get_connection_params.
+
+        The test settings use persistent connections (CONN_MAX_AGE), and Django's test
+        client does not close connections between requests, so tests that need a new
+        connection to be established have to close the existing one explicitly.
+        """
+        connections[self.db_alias].close()
 
     def test_backend_allows_database_access(self):
         response = self.client.get(f"/{self.engine}/")
         self.assertEqual(response.status_code, 200)
 
     def test_backend_uses_cached_credentials_before_refresh_interval(self):
-        start_moto_recording()
-        response = self.client.get(f"/{self.engine}/")
-        raw_log_str = stop_moto_recording()
+        self._ensure_warmed()
+        self.force_new_connection()
+        with moto_recording() as get_log:
+            response = self.client.get(f"/{self.engine}/")
+            raw_log_str = get_log()
 
         self.assertEqual(response.status_code, 200)
         # We are asserting that no AWS API calls were made to the moto server.
@@ -74,18 +186,12 @@ class TestDatabaseBackends(unittest.TestCase):
         self.assertEqual(raw_log_str, "")
 
     def test_backend_retrieves_new_creds_after_refresh_interval(self):
-        # Make an initial request to ensure initial secret retrieval has occurred
-        response = self.client.get(f"/{self.engine}/")
-        # Close old connections so that the next DB query will have to
-        # establish a new connection by calling get_connection_params
-        # Normally this would happen automatically, but Django's test
-        # runner purposely doesn't close existing connections (maybe for performance?).
-        close_old_connections()
+        self._ensure_warmed()
+        self.force_new_connection()
 
         # Make a second request and mock the time so that it looks like time to refresh.
         # We use moto's recorder feature to record the requests made to the AWS API.
-        start_moto_recording()
-        with patch(
+        with moto_recording() as get_log, patch(
             "aws_secretsmanager_caching.cache.items.datetime", autospec=True
         ) as mock_datetime:
             mock_datetime.utcnow = Mock(
@@ -93,7 +199,7 @@ class TestDatabaseBackends(unittest.TestCase):
                 + timedelta(seconds=settings.TEST_REFRESH_INTERVAL)
             )
             response = self.client.get(f"/{self.engine}/")
-        raw_log_str = stop_moto_recording()
+            raw_log_str = get_log()
 
         self.assertEqual(response.status_code, 200)
         # We are asserting that AWS API calls were made to the moto server.
@@ -101,52 +207,48 @@ class TestDatabaseBackends(unittest.TestCase):
         self.assertNotEqual(raw_log_str, "")
 
 
+class TestMySQLBackend(_DatabaseBackendTests, unittest.TestCase):
+    engine = "mysql"
+
+
+class TestPostgreSQLBackend(_DatabaseBackendTests, unittest.TestCase):
+    engine = "postgresql"
+
+
 # Disable informational logging to prevent cluttered test logs.
 logging.getLogger("secretsmanager").setLevel(logging.ERROR)
 
 
-class TestSecretKeyRefreshMiddleware(unittest.TestCase):
+class TestSecretKeyRefreshMiddleware(SimpleTestCase):
     """Test case for govtech_csg_xcg.secretsmanager.middleware.SecretKeyRefreshMiddleware."""
 
     @classmethod
     def setUpClass(cls):
-        boto3_client = boto3.client(
-            "secretsmanager", endpoint_url="http://localhost:5000"
-        )
-        boto3_client.create_secret(
-            Name="test-django-secret-key",
-            SecretString=json.dumps({"DJANGO_SECRET_KEY": settings.NEW_SECRET_KEY}),
-        )
-
-    @classmethod
-    def tearDownClass(cls):
-        boto3_client = boto3.client(
-            "secretsmanager", endpoint_url="http://localhost:5000"
-        )
-        boto3_client.delete_secret(
-            SecretId="test-django-secret-key", ForceDeleteWithoutRecovery=True
-        )
+        super().setUpClass()
+        ensure_django_secret_key_secret()
 
     def setUp(self):
-        self.client = Client()
-        # Reset the secret key settings so that we start on a clean slate.
-        settings.SECRET_KEY = settings.OLD_SECRET_KEY
-        settings.SECRET_KEY_FALLBACKS = []
+        # Start each test on a clean slate. The middleware assigns to the secret key settings
+        # directly, so overriding them per test also discards those changes afterwards.
+        secret_key_settings = self.settings(
+            SECRET_KEY=settings.OLD_SECRET_KEY, SECRET_KEY_FALLBACKS=[]
+        )
+        secret_key_settings.enable()
+        self.addCleanup(secret_key_settings.disable)
 
     def test_no_refresh_before_interval(self):
         response = self.client.get("/get_secret_key/")
         self.assertEqual(response.content.decode("utf-8"), settings.OLD_SECRET_KEY)
 
     def test_refresh_happens_after_interval(self):
-        start_moto_recording()
-        with patch(
+        with moto_recording() as get_log, patch(
             "govtech_csg_xcg.secretsmanager.middleware.time", autospec=True
         ) as mock_time:
-            mock_time.time = Mock(
-                side_effect=[time.time(), time.time() + settings.TEST_REFRESH_INTERVAL]
+            mock_time.monotonic = Mock(
+                side_effect=_clock(time.monotonic(), settings.TEST_REFRESH_INTERVAL)
             )
             response = self.client.get("/get_secret_key/")
-        raw_log_str = stop_moto_recording()
+            raw_log_str = get_log()
 
         self.assertNotEqual(raw_log_str, "")
         self.assertEqual(response.content.decode("utf-8"), settings.NEW_SECRET_KEY)
@@ -155,11 +257,55 @@ class TestSecretKeyRefreshMiddleware(unittest.TestCase):
         with patch(
             "govtech_csg_xcg.secretsmanager.middleware.time", autospec=True
         ) as mock_time:
-            mock_time.time = Mock(
-                side_effect=[time.time(), time.time() + settings.TEST_REFRESH_INTERVAL]
+            mock_time.monotonic = Mock(
+                side_effect=_clock(time.monotonic(), settings.TEST_REFRESH_INTERVAL)
             )
             self.client.get("/get_secret_key/")
 
         self.assertTrue(hasattr(settings, "SECRET_KEY_FALLBACKS"))
         self.assertEqual(len(settings.SECRET_KEY_FALLBACKS), 1)
         self.assertEqual(settings.SECRET_KEY_FALLBACKS[0], settings.OLD_SECRET_KEY)
+
+    def test_refresh_happens_in_background_when_configured(self):
+        config_dict = {
+            **settings.XCG_DJANGO_SECRET_KEY_REFRESH_CONFIG,
+            "refresh_in_background": True,
+        }
+        with self.settings(XCG_DJANGO_SECRET_KEY_REFRESH_CONFIG=config_dict):
+            middleware = SecretKeyRefreshMiddleware(lambda request: HttpResponse())
+
+        # Hold up the retrieval of the secret until we release it, to check that
+        # requests are not blocked while the refresh is in progress.
+        release_refresh = threading.Event()
+        secrets_manager = middleware.secrets_manager
+        get_secret_string = secrets_manager.get_secret_string
+
+        def blocked_get_secret_string(*args, **kwargs):
+            release_refresh.wait(timeout=10)
+            return get_secret_string(*args, **kwargs)
+
+        with patch.object(
+            type(secrets_manager),
+            "get_secret_string",
+            side_effect=blocked_get_secret_string,
+        ):
+            # Make it look like it is time to refresh.
+            middleware.next_refresh_time = time.monotonic()
+            middleware.process_request(None)
+            refresh_thread = middleware._refresh_thread
+            self.assertFalse(release_refresh.is_set())
+            self.assertTrue(refresh_thread.is_alive())
+            self.assertEqual(settings.SECRET_KEY, settings.OLD_SECRET_KEY)
+
+            # A request that is due for a refresh while one is still in progress
+            # neither waits for it nor starts another one.
+            middleware.next_refresh_time = time.monotonic()
+            middleware.process_request(None)
+            self.assertIs(middleware._refresh_thread, refresh_thread)
+            self.assertTrue(refresh_thread.is_alive())
+
+            release_refresh.set()
+            refresh_thread.join(timeout=10)
+
+        self.assertEqual(settings.SECRET_KEY, settings.NEW_SECRET_KEY)
+        self.assertEqual(settings.SECRET_KEY_FALLBACKS, [settings.OLD_SECRET_KEY])
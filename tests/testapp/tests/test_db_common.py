@@ -0,0 +1,216 @@
+import json
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import boto3
+from django.db import DatabaseError
+from moto import mock_secretsmanager
+
+from govtech_csg_xcg.secretsmanager.clients import clear_caches
+from govtech_csg_xcg.secretsmanager.db.common import (
+    DatabaseCredentials,
+    prefetch_database_credentials,
+)
+
+# Set up dummy AWS credentials to prevent accidental mutation of real infrastructure
+os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+os.environ["AWS_SECURITY_TOKEN"] = "testing"
+os.environ["AWS_SESSION_TOKEN"] = "testing"
+os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+
+
+class TestPrefetchDatabaseCredentials(unittest.TestCase):
+    """Test case for govtech_csg_xcg.secretsmanager.db.common.prefetch_database_credentials."""
+
+    def setUp(self):
+        # DatabaseCredentials with the same configuration share a CacheSecretsManager,
+        # so both the mock AWS state and the shared instances are reset after each test.
+        mock = mock_secretsmanager()
+        mock.start()
+        self.addCleanup(mock.stop)
+        self.addCleanup(clear_caches)
+        self.boto3_client = boto3.client("secretsmanager")
+
+    def create_db_credentials(self, count):
+        """Create count DB secrets in the mock AWS state, and DatabaseCredentials for each."""
+        db_credentials = []
+        for i in range(count):
+            secret_name = f"test-db-secret-{i}"
+            self.boto3_client.create_secret(
+                Name=secret_name,
+                SecretString=json.dumps(
+                    {
+                        "username": f"user-{i}",
+                        "password": f"password-{i}",
+                        "host": f"host-{i}",
+                        "dbname": f"db-{i}",
+                    }
+                ),
+            )
+            db_credentials.append(DatabaseCredentials({"secret_arn": secret_name}))
+        return db_credentials
+
+    def test_prefetch_populates_cache_for_all_credentials(self):
+        db_credentials = self.create_db_credentials(3)
+        prefetch_database_credentials(db_credentials)
+
+        client = db_credentials[0].cache_secrets_manager._client
+        with patch.object(
+            client, "describe_secret", wraps=client.describe_secret
+        ) as mock_describe_secret, patch.object(
+            client, "get_secret_value", wraps=client.get_secret_value
+        ) as mock_get_secret_value:
+            settings_dicts = [{} for _ in db_credentials]
+            for creds, settings_dict in zip(db_credentials, settings_dicts):
+                creds.fill_settings_dict(settings_dict, default_port=5432)
+
+        mock_describe_secret.assert_not_called()
+        mock_get_secret_value.assert_not_called()
+        for i, settings_dict in enumerate(settings_dicts):
+            self.assertEqual(
+                settings_dict,
+                {
+                    "USER": f"user-{i}",
+                    "PASSWORD": f"password-{i}",
+                    "HOST": f"host-{i}",
+                    "NAME": f"db-{i}",
+                    "PORT": 5432,
+                },
+            )
+
+    def test_prefetch_with_max_workers_limits_threads(self):
+        db_credentials = self.create_db_credentials(3)
+        with patch(
+            "govtech_csg_xcg.secretsmanager.db.common.ThreadPoolExecutor",
+            wraps=ThreadPoolExecutor,
+        ) as mock_executor:
+            prefetch_database_credentials(db_credentials, max_workers=1)
+
+        mock_executor.assert_called_once_with(max_workers=1)
+        for creds in db_credentials:
+            settings_dict = {}
+            creds.fill_settings_dict(settings_dict, default_port=3306)
+            self.assertEqual(settings_dict["PORT"], 3306)
+
+    def test_prefetch_uses_no_more_threads_than_credentials(self):
+        db_credentials = self.create_db_credentials(2)
+        with patch(
+            "govtech_csg_xcg.secretsmanager.db.common.ThreadPoolExecutor",
+            wraps=ThreadPoolExecutor,
+        ) as mock_executor:
+            prefetch_database_credentials(db_credentials, max_workers=8)
+
+        mock_executor.assert_called_once_with(max_workers=2)
+
+    def test_prefetch_with_no_credentials_does_nothing(self):
+        with patch(
+            "govtech_csg_xcg.secretsmanager.db.common.ThreadPoolExecutor"
+        ) as mock_executor:
+            prefetch_database_credentials([])
+
+        mock_executor.assert_not_called()
+
+    def test_prefetch_with_missing_secret_raises_database_error(self):
+        db_credentials = self.create_db_credentials(1)
+        db_credentials.append(
+            DatabaseCredentials({"secret_arn": "non-existent-db-secret"})
+        )
+
+        with self.assertRaises(DatabaseError):
+            prefetch_database_credentials(db_credentials)
+
+
+class TestDatabaseCredentials(unittest.TestCase):
+    """Test case for the settings memoization in DatabaseCredentials.fill_settings_dict."""
+
+    def setUp(self):
+        mock = mock_secretsmanager()
+        mock.start()
+        self.addCleanup(mock.stop)
+        self.addCleanup(clear_caches)
+        self.boto3_client = boto3.client("secretsmanager")
+
+        self.secret_name = "test-db-secret"
+        self.boto3_client.create_secret(
+            Name=self.secret_name,
+            SecretString=json.dumps(
+                {
+                    "username": "user-1",
+                    "password": "password-1",
+                    "host": "host-1",
+                    "dbname": "db-1",
+                }
+            ),
+        )
+        self.db_credentials = DatabaseCredentials({"secret_arn": self.secret_name})
+
+    def test_fill_settings_dict_parses_secret_only_once(self):
+        with patch(
+            "govtech_csg_xcg.secretsmanager.db.common._json.loads",
+            wraps=json.loads,
+        ) as mock_loads:
+            for _ in range(3):
+                settings_dict = {}
+                self.db_credentials.fill_settings_dict(settings_dict, default_port=5432)
+                self.assertEqual(settings_dict["USER"], "user-1")
+
+        self.assertEqual(mock_loads.call_count, 1)
+
+    def test_fill_settings_dict_with_force_refresh_uses_changed_secret(self):
+        self.db_credentials.fill_settings_dict({}, default_port=5432)
+        self.boto3_client.put_secret_value(
+            SecretId=self.secret_name,
+            SecretString=json.dumps(
+                {
+                    "username": "user-2",
+                    "password": "password-2",
+                    "host": "host-2",
+                    "port": "6432",
+                }
+            ),
+        )
+        settings_dict = {}
+        self.db_credentials.fill_settings_dict(
+            settings_dict, default_port=5432, force_refresh=True
+        )
+
+        self.assertEqual(
+            settings_dict,
+            {
+                "USER": "user-2",
+                "PASSWORD": "password-2",
+                "HOST": "host-2",
+                "NAME": None,
+                "PORT": 6432,
+            },
+        )
+
+    def test_fill_settings_dict_with_changed_default_port_updates_port(self):
+        mysql_settings_dict = {}
+        self.db_credentials.fill_settings_dict(mysql_settings_dict, default_port=3306)
+        postgresql_settings_dict = {}
+        self.db_credentials.fill_settings_dict(
+            postgresql_settings_dict, default_port=5432
+        )
+
+        self.assertEqual(mysql_settings_dict["PORT"], 3306)
+        self.assertEqual(postgresql_settings_dict["PORT"], 5432)
+
+    def test_fill_settings_dict_with_missing_key_raises_without_caching(self):
+        self.db_credentials.fill_settings_dict({}, default_port=5432)
+        self.boto3_client.put_secret_value(
+            SecretId=self.secret_name,
+            SecretString=json.dumps({"username": "user-2", "host": "host-2"}),
+        )
+
+        for force_refresh in (True, False):
+            settings_dict = {}
+            with self.subTest(force_refresh=force_refresh):
+                with self.assertRaises(KeyError):
+                    self.db_credentials.fill_settings_dict(
+                        settings_dict, default_port=5432, force_refresh=force_refresh
+                    )
+                self.assertEqual(settings_dict, {})
@@ -1,9 +1,8 @@
-from django.urls import path
+from django.urls import path, re_path
 
 from . import views
 
 urlpatterns = [
-    path("mysql/", views.access_mysql_db),
-    path("postgresql/", views.access_postgresql_db),
+    re_path(r"^(?P<alias>mysql|postgresql)/$", views.access_db),
     path("get_secret_key/", views.get_secret_key),
 ]
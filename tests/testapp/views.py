@@ -1,18 +1,14 @@
 from django.conf import settings
+from django.db import connections
 from django.http import HttpResponse
 
-from .models import TestModel
 
-
-def access_mysql_db(request):
-    # Calling list() on the queryset forces evaluation, which hits the DB
-    list(TestModel.objects.using("mysql_test").all())
-    return HttpResponse("Successfully hit DB")
-
-
-def access_postgresql_db(request):
-    # Calling list() on the queryset forces evaluation, which hits the DB
-    list(TestModel.objects.using("postgresql_test").all())
+def access_db(request, alias):
+    # Opening a cursor connects to the DB (and so fetches the credentials), and a
+    # trivial query confirms the connection works without going through the ORM
+    with connections[f"{alias}_test"].cursor() as cursor:
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
     return HttpResponse("Successfully hit DB")
 
 
@@ -104,6 +104,8 @@ DATABASES = {
             "region_name": "ap-southeast-1",
             "refresh_interval": TEST_REFRESH_INTERVAL,
         },
+        "CONN_MAX_AGE": 60,
+        "CONN_HEALTH_CHECKS": True,
         "TEST": {
             "DEPENDENCIES": [],
         },
@@ -115,6 +117,8 @@ DATABASES = {
             "region_name": "ap-southeast-1",
             "refresh_interval": TEST_REFRESH_INTERVAL,
         },
+        "CONN_MAX_AGE": 60,
+        "CONN_HEALTH_CHECKS": True,
         "TEST": {
             "DEPENDENCIES": [],
         },